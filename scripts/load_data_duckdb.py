@@ -7,17 +7,91 @@ import duckdb
 import pandas as pd
 from pathlib import Path
 import logging
+import os
+import shutil
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 DATA_FILE = 'NSE_data_3M.csv'
 DB_FILE = 'fo_analytics.duckdb'
+TRADES_DIR = 'trades'
+MEMORY_LIMIT = '8GB'
+
+
+def create_raw_data_view(conn):
+    """Expose the source CSV as the raw_data temp view"""
+    
+    logger.info("Loading CSV data...")
+    
+    # A view, not a table: each insert in load_data_duckdb parses it in parallel
+    # instead of copying it into a temp table first. Every column is read as
+    # VARCHAR (no type sniffing) and cast with TRY_CAST, so a malformed field
+    # becomes NULL instead of dropping its row.
+    conn.execute(f"""
+        CREATE OR REPLACE TEMP VIEW raw_data AS
+        SELECT 
+            INSTRUMENT as instrument,
+            SYMBOL as symbol,
+            TRY_CAST(try_strptime(EXPIRY_DT, '%d-%b-%Y') AS DATE) as expiry_dt,
+            COALESCE(TRY_CAST(STRIKE_PR AS DECIMAL(12,2)), 0) as strike_pr,  -- 0 for futures
+            COALESCE(OPTION_TYP, 'XX') as option_typ,
+            TRY_CAST(OPEN AS DECIMAL(12,2)) as open,
+            TRY_CAST(HIGH AS DECIMAL(12,2)) as high,
+            TRY_CAST(LOW AS DECIMAL(12,2)) as low,
+            TRY_CAST(CLOSE AS DECIMAL(12,2)) as close,
+            TRY_CAST(SETTLE_PR AS DECIMAL(12,2)) as settle_pr,
+            TRY_CAST(CONTRACTS AS BIGINT) as contracts,
+            TRY_CAST(VAL_INLAKH AS DECIMAL(15,2)) as val_inlakh,
+            TRY_CAST(OPEN_INT AS BIGINT) as open_int,
+            TRY_CAST(CHG_IN_OI AS BIGINT) as chg_in_oi,
+            try_strptime(TIMESTAMP, '%d-%b-%Y') as timestamp
+        FROM read_csv('{DATA_FILE}', header=true, ignore_errors=true, parallel=true,
+            all_varchar=true)
+    """)
 
 
 def create_duckdb_schema(conn):
     """Create database schema in DuckDB"""
     
+    # Low-cardinality codes stored as 1-byte enums whose values come from the
+    # data, so a new INSTRUMENT or OPTION_TYP code never fails the load
+    conn.execute("""
+        CREATE OR REPLACE TEMP TABLE raw_codes AS
+        SELECT instrument, option_typ, COUNT(*) as n_rows
+        FROM raw_data
+        GROUP BY instrument, option_typ
+    """)
+    
+    conn.execute("""
+        CREATE TYPE IF NOT EXISTS option_type_t AS ENUM (
+            SELECT DISTINCT option_typ FROM raw_codes ORDER BY option_typ
+        )
+    """)
+    
+    conn.execute("""
+        CREATE TYPE IF NOT EXISTS instr_type_t AS ENUM (
+            SELECT DISTINCT instrument FROM raw_codes
+            WHERE instrument IS NOT NULL
+            ORDER BY instrument
+        )
+    """)
+    
+    # Enum types cannot be extended, so when reloading into an existing
+    # database, rows with codes it has not seen are skipped
+    result = conn.execute("""
+        SELECT COALESCE(SUM(n_rows), 0) FROM raw_codes
+        WHERE (instrument IS NOT NULL AND TRY_CAST(instrument AS instr_type_t) IS NULL)
+            OR TRY_CAST(option_typ AS option_type_t) IS NULL
+    """).fetchone()
+    if result[0]:
+        logger.warning(f"Skipping {result[0]:,} rows with instrument/option types unknown "
+                       f"to the existing {DB_FILE}; delete it and reload to include them")
+    
+    # Surrogate key generators (parallel-safe, unlike ROW_NUMBER() OVER ())
+    conn.execute("CREATE SEQUENCE IF NOT EXISTS instrument_seq")
+    conn.execute("CREATE SEQUENCE IF NOT EXISTS expiry_seq")
+    
     # Create tables
     conn.execute("""
         CREATE TABLE IF NOT EXISTS exchanges (
@@ -41,7 +115,7 @@ def create_duckdb_schema(conn):
         CREATE TABLE IF NOT EXISTS instruments (
             instrument_id INTEGER PRIMARY KEY,
             exchange_id INTEGER,
-            instrument_type VARCHAR,
+            instrument_type instr_type_t,
             symbol VARCHAR,
             series VARCHAR,
             UNIQUE(exchange_id, instrument_type, symbol)
@@ -54,29 +128,12 @@ def create_duckdb_schema(conn):
             instrument_id INTEGER,
             expiry_date DATE,
             strike_price DECIMAL(12, 2),
-            option_type VARCHAR,
+            option_type option_type_t,
             UNIQUE(instrument_id, expiry_date, strike_price, option_type)
         )
     """)
     
-    conn.execute("""
-        CREATE TABLE IF NOT EXISTS trades (
-            trade_id INTEGER PRIMARY KEY,
-            expiry_id INTEGER,
-            instrument_id INTEGER,
-            trade_date DATE,
-            open DECIMAL(12, 2),
-            high DECIMAL(12, 2),
-            low DECIMAL(12, 2),
-            close DECIMAL(12, 2),
-            settle_price DECIMAL(12, 2),
-            contracts BIGINT,
-            value_in_lakh DECIMAL(15, 2),
-            open_interest BIGINT,
-            change_in_oi BIGINT,
-            timestamp TIMESTAMP
-        )
-    """)
+    # trades is written to Parquet by load_data_duckdb and exposed as a view
     
     logger.info("Schema created successfully")
 
@@ -84,35 +141,11 @@ def create_duckdb_schema(conn):
 def load_data_duckdb(conn):
     """Load data directly from CSV using DuckDB's efficient CSV reader"""
     
-    logger.info("Loading CSV data...")
-    
-    # Read CSV with column transformations
-    conn.execute("""
-        CREATE TEMP TABLE raw_data AS
-        SELECT 
-            INSTRUMENT as instrument,
-            SYMBOL as symbol,
-            TRY_CAST(strptime(EXPIRY_DT, '%d-%b-%Y') AS DATE) as expiry_dt,
-            TRY_CAST(STRIKE_PR AS DECIMAL(12,2)) as strike_pr,
-            OPTION_TYP as option_typ,
-            TRY_CAST(OPEN AS DECIMAL(12,2)) as open,
-            TRY_CAST(HIGH AS DECIMAL(12,2)) as high,
-            TRY_CAST(LOW AS DECIMAL(12,2)) as low,
-            TRY_CAST(CLOSE AS DECIMAL(12,2)) as close,
-            TRY_CAST(SETTLE_PR AS DECIMAL(12,2)) as settle_pr,
-            TRY_CAST(CONTRACTS AS BIGINT) as contracts,
-            TRY_CAST(VAL_INLAKH AS DECIMAL(15,2)) as val_inlakh,
-            TRY_CAST(OPEN_INT AS BIGINT) as open_int,
-            TRY_CAST(CHG_IN_OI AS BIGINT) as chg_in_oi,
-            TRY_CAST(strptime(TIMESTAMP, '%d-%b-%Y') AS TIMESTAMP) as timestamp
-        FROM read_csv_auto(?, header=true, ignore_errors=true, sample_size=100000)
-    """, [DATA_FILE])
-    
     logger.info("Inserting instruments...")
     conn.execute("""
         INSERT INTO instruments
         SELECT 
-            ROW_NUMBER() OVER () as instrument_id,
+            nextval('instrument_seq') as instrument_id,
             1 as exchange_id,  -- NSE
             instrument,
             symbol,
@@ -120,6 +153,7 @@ def load_data_duckdb(conn):
         FROM (
             SELECT DISTINCT instrument, symbol
             FROM raw_data
+            WHERE TRY_CAST(instrument AS instr_type_t) IS NOT NULL
         )
         ON CONFLICT DO NOTHING
     """)
@@ -128,55 +162,99 @@ def load_data_duckdb(conn):
     conn.execute("""
         INSERT INTO expiries
         SELECT 
-            ROW_NUMBER() OVER () as expiry_id,
+            nextval('expiry_seq') as expiry_id,
             i.instrument_id,
             r.expiry_dt,
-            COALESCE(r.strike_pr, 0) as strike_price,
-            COALESCE(r.option_typ, 'XX') as option_type
+            r.strike_pr as strike_price,
+            r.option_typ as option_type
         FROM (
             SELECT DISTINCT 
                 instrument, symbol, expiry_dt, strike_pr, option_typ
             FROM raw_data
             WHERE expiry_dt IS NOT NULL
+                AND TRY_CAST(option_typ AS option_type_t) IS NOT NULL
         ) r
         JOIN instruments i ON r.instrument = i.instrument_type 
             AND r.symbol = i.symbol
+        -- Stored in (option_type, expiry_date, strike) order so zonemaps
+        -- skip row groups on CE/PE and expiry filters
+        ORDER BY r.option_typ, r.expiry_dt, r.strike_pr
         ON CONFLICT DO NOTHING
     """)
     
-    logger.info("Inserting trades...")
+    # One lookup row per contract, so trades resolves both surrogate keys
+    # with a single hash join against raw_data
     conn.execute("""
-        INSERT INTO trades
+        CREATE OR REPLACE TEMP TABLE contract_map AS
         SELECT 
-            ROW_NUMBER() OVER () as trade_id,
-            ex.expiry_id,
-            i.instrument_id,
+            i.instrument_type as instrument,
+            i.symbol,
+            ex.expiry_date,
+            ex.strike_price,
+            ex.option_type,
+            ex.instrument_id,
+            ex.expiry_id
+        FROM expiries ex
+        JOIN instruments i ON ex.instrument_id = i.instrument_id
+    """)
+    
+    # Columnar Parquet, one hive partition per trade month, sorted by
+    # (instrument_id, trade_date) so file and row-group min/max statistics
+    # prune symbol and date range predicates
+    logger.info("Writing trades to Parquet...")
+    shutil.rmtree(TRADES_DIR, ignore_errors=True)
+    # trades is rewritten from scratch, so number it from 1 on every load
+    conn.execute("CREATE OR REPLACE SEQUENCE trade_seq")
+    conn.execute("""
+        CREATE OR REPLACE TEMP TABLE trades_staging AS
+        SELECT 
+            CAST(nextval('trade_seq') AS INTEGER) as trade_id,
+            m.expiry_id,
+            m.instrument_id,
             CAST(r.timestamp AS DATE) as trade_date,
-            COALESCE(r.open, 0),
-            COALESCE(r.high, 0),
-            COALESCE(r.low, 0),
-            COALESCE(r.close, 0),
-            COALESCE(r.settle_pr, 0),
-            COALESCE(r.contracts, 0),
-            COALESCE(r.val_inlakh, 0),
-            COALESCE(r.open_int, 0),
-            COALESCE(r.chg_in_oi, 0),
-            r.timestamp
+            -- Prices quantized to integer paise (rupees x 100)
+            CAST(COALESCE(r.open, 0) * 100 AS INTEGER) as open_paise,
+            CAST(COALESCE(r.high, 0) * 100 AS INTEGER) as high_paise,
+            CAST(COALESCE(r.low, 0) * 100 AS INTEGER) as low_paise,
+            CAST(COALESCE(r.close, 0) * 100 AS INTEGER) as close_paise,
+            CAST(COALESCE(r.settle_pr, 0) * 100 AS INTEGER) as settle_price_paise,
+            COALESCE(r.contracts, 0) as contracts,
+            COALESCE(r.val_inlakh, 0) as value_in_lakh,
+            COALESCE(r.open_int, 0) as open_interest,
+            COALESCE(r.chg_in_oi, 0) as change_in_oi,
+            r.timestamp,
+            strftime(r.timestamp, '%Y-%m') as year_month
         FROM raw_data r
-        JOIN instruments i ON r.instrument = i.instrument_type 
-            AND r.symbol = i.symbol
-        JOIN expiries ex ON ex.instrument_id = i.instrument_id
-            AND ex.expiry_date = r.expiry_dt
-            AND COALESCE(ex.strike_price, 0) = COALESCE(r.strike_pr, 0)
-            AND COALESCE(ex.option_type, 'XX') = COALESCE(r.option_typ, 'XX')
+        JOIN contract_map m ON m.instrument = r.instrument
+            AND m.symbol = r.symbol
+            AND m.expiry_date = r.expiry_dt
+            AND m.strike_price = r.strike_pr
+            AND m.option_type = r.option_typ
         WHERE r.timestamp IS NOT NULL
     """)
     
-    # Create indexes
-    logger.info("Creating indexes...")
-    conn.execute("CREATE INDEX idx_trades_instrument ON trades(instrument_id)")
-    conn.execute("CREATE INDEX idx_trades_date ON trades(trade_date)")
-    conn.execute("CREATE INDEX idx_trades_symbol_date ON trades(instrument_id, trade_date)")
+    # One COPY per month: PARTITION_BY does not keep the ORDER BY within files
+    months = conn.execute(
+        "SELECT DISTINCT year_month FROM trades_staging ORDER BY year_month"
+    ).fetchall()
+    for (year_month,) in months:
+        partition_dir = Path(TRADES_DIR) / f"year_month={year_month}"
+        partition_dir.mkdir(parents=True)
+        conn.execute(f"""
+            COPY (
+                SELECT * EXCLUDE (year_month)
+                FROM trades_staging
+                WHERE year_month = '{year_month}'
+                ORDER BY instrument_id, trade_date
+            ) TO '{(partition_dir / 'data_0.parquet').as_posix()}'
+            (FORMAT PARQUET, COMPRESSION ZSTD, ROW_GROUP_SIZE 100000)
+        """)
+    conn.execute("DROP TABLE trades_staging")
+    
+    conn.execute(f"""
+        CREATE OR REPLACE VIEW trades AS
+        SELECT * FROM read_parquet('{TRADES_DIR}/*/*.parquet', hive_partitioning=1)
+    """)
     
     # Get statistics
     result = conn.execute("SELECT COUNT(*) FROM trades").fetchone()
@@ -189,6 +267,62 @@ def load_data_duckdb(conn):
     logger.info(f"Loaded {result[0]:,} expiry contracts")
 
 
+def create_preaggregates(conn):
+    """Materialize per-day rollups shared by the analytical queries"""
+
+    logger.info("Building daily_symbol_agg...")
+    conn.execute("""
+        CREATE OR REPLACE TABLE daily_symbol_agg AS
+        SELECT
+            i.symbol,
+            e.exchange_code,
+            i.instrument_type,
+            t.trade_date,
+            SUM(t.contracts) as sum_contracts,
+            SUM(t.open_interest) as sum_oi,
+            SUM(t.change_in_oi) as sum_chg_oi,
+            AVG(t.close_paise) / 100.0 as avg_close,
+            SUM(t.close_paise) / 100.0 as sum_close,
+            SUM(t.value_in_lakh) as sum_value_lakh,
+            COUNT(*) as n_rows
+        FROM trades t
+        JOIN instruments i ON t.instrument_id = i.instrument_id
+        JOIN exchanges e ON i.exchange_id = e.exchange_id
+        GROUP BY i.symbol, e.exchange_code, i.instrument_type, t.trade_date
+    """)
+    conn.execute("CREATE INDEX idx_daily_symbol_agg ON daily_symbol_agg(symbol, trade_date)")
+
+    logger.info("Building daily_option_agg...")
+    conn.execute("""
+        CREATE OR REPLACE TABLE daily_option_agg AS
+        SELECT
+            i.symbol,
+            ex.expiry_date,
+            ex.strike_price,
+            ex.option_type,
+            t.trade_date,
+            SUM(t.contracts) as sum_contracts,
+            SUM(t.open_interest) as sum_oi,
+            AVG(t.close_paise) / 100.0 as avg_close,
+            SUM(t.close_paise) / 100.0 as sum_close,
+            SUM(t.value_in_lakh) as sum_value_lakh,
+            COUNT(*) as n_rows
+        FROM trades t
+        JOIN expiries ex ON t.expiry_id = ex.expiry_id
+        JOIN instruments i ON t.instrument_id = i.instrument_id
+        WHERE ex.option_type IN ('CE', 'PE')
+        GROUP BY i.symbol, ex.expiry_date, ex.strike_price, ex.option_type, t.trade_date
+        ORDER BY i.symbol, ex.expiry_date, ex.option_type, ex.strike_price, t.trade_date
+    """)
+    conn.execute("CREATE INDEX idx_daily_option_agg ON daily_option_agg(symbol, expiry_date)")
+
+    result = conn.execute("SELECT COUNT(*) FROM daily_symbol_agg").fetchone()
+    logger.info(f"Built {result[0]:,} symbol-day rows")
+
+    result = conn.execute("SELECT COUNT(*) FROM daily_option_agg").fetchone()
+    logger.info(f"Built {result[0]:,} option-day rows")
+
+
 def main():
     """Main execution"""
     try:
@@ -196,11 +330,24 @@ def main():
         conn = duckdb.connect(DB_FILE)
         logger.info(f"Connected to DuckDB: {DB_FILE}")
         
+        # Use every core for the parallel CSV reader and joins
+        conn.execute(f"SET threads={os.cpu_count()}")
+        conn.execute(f"SET memory_limit='{MEMORY_LIMIT}'")
+        
+        # Source CSV view (the schema derives its enum types from it)
+        create_raw_data_view(conn)
+        
         # Create schema
         create_duckdb_schema(conn)
         
         # Load data
         load_data_duckdb(conn)
+
+        # Build shared rollups for the query scripts
+        create_preaggregates(conn)
+
+        # Flush the WAL into compressed blocks so readers start from a clean file
+        conn.execute("CHECKPOINT")
         
         logger.info("Data loading complete!")
         
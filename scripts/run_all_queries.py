@@ -1,18 +1,46 @@
 """
 Execute all 7 analytical queries and save outputs
 F&O Database Analytics - Query Results
+
+Distinct counts (Q1 trading_days, Q3 unique_symbols, Q7 num_strikes) stay exact:
+they run over the daily rollups, where groups hold at most a few hundred values,
+and approx_count_distinct is 10-20% off at that cardinality.
 """
 import duckdb
 import pandas as pd
 from datetime import datetime
 
+DB_FILE = 'fo_analytics.duckdb'
+
 # Connect to database
-conn = duckdb.connect('fo_analytics.duckdb')
+conn = duckdb.connect(DB_FILE)
 
 # Create results directory
 import os
 os.makedirs('query_outputs', exist_ok=True)
 
+# Run every query in one transaction so catalog lookups are shared
+conn.execute("BEGIN TRANSACTION")
+
+
+def run_query(sql, output_path):
+    """Execute a query once, write it to CSV from DuckDB and return it for display"""
+    conn.execute(f"CREATE OR REPLACE TEMP TABLE query_result AS {sql}")
+    conn.execute(f"COPY query_result TO '{output_path}' (HEADER, DELIMITER ',')")
+    print(f"Saved: {output_path}\n")
+    return conn.execute("SELECT * FROM query_result").fetchdf()
+
+
+def run_if_stale(name, sql, deps=(DB_FILE, __file__)):
+    """Reuse query_outputs/<name>.csv when it is newer than the database and this script"""
+    output_path = f'query_outputs/{name}.csv'
+    if os.path.exists(output_path) and \
+            os.path.getmtime(output_path) > max(os.path.getmtime(d) for d in deps):
+        print(f"Cached: {output_path} is newer than {', '.join(map(str, deps))}\n")
+        return pd.read_csv(output_path)
+    return run_query(sql, output_path)
+
+
 print("=" * 100)
 print("F&O DATABASE ANALYTICS - RUNNING ALL 7 QUERIES")
 print("=" * 100)
@@ -25,52 +53,40 @@ print("-" * 100)
 
 query1 = """
 SELECT 
-    i.symbol,
-    e.exchange_code,
-    SUM(t.change_in_oi) as net_oi_change,
-    ROUND(AVG(t.open_interest), 0) as avg_open_interest,
-    SUM(t.contracts) as cumulative_volume,
-    COUNT(DISTINCT t.trade_date) as trading_days
-FROM trades t
-JOIN instruments i ON t.instrument_id = i.instrument_id
-JOIN exchanges e ON i.exchange_id = e.exchange_id
-WHERE t.trade_date >= '2019-08-01'
-GROUP BY i.symbol, e.exchange_code
+    symbol,
+    exchange_code,
+    SUM(sum_chg_oi) as net_oi_change,
+    ROUND(SUM(sum_oi) / SUM(n_rows), 0) as avg_open_interest,
+    SUM(sum_contracts) as cumulative_volume,
+    COUNT(DISTINCT trade_date) as trading_days
+FROM daily_symbol_agg
+WHERE trade_date >= '2019-08-01'
+GROUP BY symbol, exchange_code
 ORDER BY ABS(net_oi_change) DESC
 LIMIT 10
 """
 
-df1 = conn.execute(query1).fetchdf()
+df1 = run_if_stale('query1_oi_change', query1)
 print(df1.to_string(index=False))
-df1.to_csv('query_outputs/query1_oi_change.csv', index=False)
-print("\nSaved: query_outputs/query1_oi_change.csv")
 
 # QUERY 2: 7-Day Volatility Analysis
 print("\n[2/7] QUERY 2: 7-Day Rolling Volatility for Top Symbols")
 print("-" * 100)
 
 query2 = """
-WITH daily_closes AS (
-    SELECT 
-        i.symbol,
-        t.trade_date,
-        AVG(t.close) as avg_close
-    FROM trades t
-    JOIN instruments i ON t.instrument_id = i.instrument_id
-    WHERE t.trade_date >= '2019-08-01'
-    GROUP BY i.symbol, t.trade_date
-),
-rolling_volatility AS (
+WITH rolling_volatility AS (
     SELECT 
         symbol,
         trade_date,
-        avg_close,
-        STDDEV(avg_close) OVER (
+        SUM(sum_close) / SUM(n_rows) as avg_close,
+        STDDEV(SUM(sum_close) / SUM(n_rows)) OVER (
             PARTITION BY symbol 
             ORDER BY trade_date 
             ROWS BETWEEN 6 PRECEDING AND CURRENT ROW
         ) as rolling_7day_stddev
-    FROM daily_closes
+    FROM daily_symbol_agg
+    WHERE trade_date >= '2019-08-01'
+    GROUP BY symbol, trade_date
 )
 SELECT 
     symbol,
@@ -86,10 +102,8 @@ ORDER BY avg_volatility DESC
 LIMIT 10
 """
 
-df2 = conn.execute(query2).fetchdf()
+df2 = run_if_stale('query2_volatility', query2)
 print(df2.to_string(index=False))
-df2.to_csv('query_outputs/query2_volatility.csv', index=False)
-print("\nSaved: query_outputs/query2_volatility.csv")
 
 # QUERY 3: Cross-Exchange Comparison
 print("\n[3/7] QUERY 3: Cross-Exchange Volume Comparison")
@@ -97,68 +111,60 @@ print("-" * 100)
 
 query3 = """
 SELECT 
-    e.exchange_code,
-    i.instrument_type,
-    COUNT(DISTINCT i.symbol) as unique_symbols,
-    SUM(t.contracts) as total_volume,
-    ROUND(SUM(t.value_in_lakh), 2) as total_value_lakh,
-    ROUND(AVG(t.close), 2) as avg_settlement_price
-FROM trades t
-JOIN instruments i ON t.instrument_id = i.instrument_id
-JOIN exchanges e ON i.exchange_id = e.exchange_id
-GROUP BY e.exchange_code, i.instrument_type
+    exchange_code,
+    instrument_type,
+    COUNT(DISTINCT symbol) as unique_symbols,
+    SUM(sum_contracts) as total_volume,
+    ROUND(SUM(sum_value_lakh), 2) as total_value_lakh,
+    ROUND(SUM(sum_close) / SUM(n_rows), 2) as avg_settlement_price
+FROM daily_symbol_agg
+GROUP BY exchange_code, instrument_type
 ORDER BY total_volume DESC
 """
 
-df3 = conn.execute(query3).fetchdf()
+df3 = run_if_stale('query3_cross_exchange', query3)
 print(df3.to_string(index=False))
-df3.to_csv('query_outputs/query3_cross_exchange.csv', index=False)
-print("\nSaved: query_outputs/query3_cross_exchange.csv")
 
 # QUERY 4: Option Chain Summary
 print("\n[4/7] QUERY 4: NIFTY Option Chain Summary")
 print("-" * 100)
 
 query4 = """
-WITH option_summary AS (
+WITH target_expiry AS (
+    SELECT MIN(expiry_date) as expiry_date
+    FROM expiries
+    WHERE expiry_date >= DATE '2019-09-26'
+),
+option_summary AS (
     SELECT 
-        ex.expiry_date,
-        ex.strike_price,
-        ex.option_type,
-        SUM(t.contracts) as total_volume,
-        SUM(t.open_interest) as total_oi,
-        ROUND(AVG(t.close), 2) as avg_premium
-    FROM trades t
-    JOIN expiries ex ON t.expiry_id = ex.expiry_id
-    JOIN instruments i ON t.instrument_id = i.instrument_id
-    WHERE i.symbol = 'NIFTY'
-        AND ex.option_type IN ('CE', 'PE')
-        AND ex.expiry_date = (
-            SELECT MIN(expiry_date) 
-            FROM expiries 
-            WHERE expiry_date >= '2019-09-26'
-        )
-    GROUP BY ex.expiry_date, ex.strike_price, ex.option_type
+        expiry_date,
+        strike_price,
+        option_type,
+        SUM(sum_contracts) as total_volume,
+        SUM(sum_oi) as total_oi,
+        ROUND(SUM(sum_close) / SUM(n_rows), 2) as avg_premium
+    FROM daily_option_agg
+    SEMI JOIN target_expiry USING (expiry_date)
+    WHERE symbol = 'NIFTY'
+    GROUP BY expiry_date, strike_price, option_type
 )
 SELECT 
     expiry_date,
     strike_price,
-    MAX(CASE WHEN option_type = 'CE' THEN total_volume ELSE 0 END) as CE_volume,
-    MAX(CASE WHEN option_type = 'PE' THEN total_volume ELSE 0 END) as PE_volume,
-    MAX(CASE WHEN option_type = 'CE' THEN total_oi ELSE 0 END) as CE_oi,
-    MAX(CASE WHEN option_type = 'PE' THEN total_oi ELSE 0 END) as PE_oi,
-    MAX(CASE WHEN option_type = 'CE' THEN avg_premium ELSE 0 END) as CE_premium,
-    MAX(CASE WHEN option_type = 'PE' THEN avg_premium ELSE 0 END) as PE_premium
+    COALESCE(MAX(total_volume) FILTER (WHERE option_type = 'CE'), 0) as CE_volume,
+    COALESCE(MAX(total_volume) FILTER (WHERE option_type = 'PE'), 0) as PE_volume,
+    COALESCE(MAX(total_oi) FILTER (WHERE option_type = 'CE'), 0) as CE_oi,
+    COALESCE(MAX(total_oi) FILTER (WHERE option_type = 'PE'), 0) as PE_oi,
+    COALESCE(MAX(avg_premium) FILTER (WHERE option_type = 'CE'), 0) as CE_premium,
+    COALESCE(MAX(avg_premium) FILTER (WHERE option_type = 'PE'), 0) as PE_premium
 FROM option_summary
 GROUP BY expiry_date, strike_price
 ORDER BY strike_price
 LIMIT 15
 """
 
-df4 = conn.execute(query4).fetchdf()
+df4 = run_if_stale('query4_option_chain', query4)
 print(df4.to_string(index=False))
-df4.to_csv('query_outputs/query4_option_chain.csv', index=False)
-print("\nSaved: query_outputs/query4_option_chain.csv")
 
 # QUERY 5: Max Volume (Performance Optimized)
 print("\n[5/7] QUERY 5: Highest Volume Trading Days (Optimized)")
@@ -167,14 +173,13 @@ print("-" * 100)
 query5 = """
 WITH ranked_volume AS (
     SELECT 
-        i.symbol,
-        t.trade_date,
-        SUM(t.contracts) as daily_volume,
-        ROW_NUMBER() OVER (PARTITION BY i.symbol ORDER BY SUM(t.contracts) DESC) as rank
-    FROM trades t
-    JOIN instruments i ON t.instrument_id = i.instrument_id
-    WHERE t.contracts > 0
-    GROUP BY i.symbol, t.trade_date
+        symbol,
+        trade_date,
+        SUM(sum_contracts) as daily_volume,
+        ROW_NUMBER() OVER (PARTITION BY symbol ORDER BY SUM(sum_contracts) DESC) as rank
+    FROM daily_symbol_agg
+    GROUP BY symbol, trade_date
+    HAVING SUM(sum_contracts) > 0
 )
 SELECT 
     symbol,
@@ -186,37 +191,41 @@ ORDER BY daily_volume DESC
 LIMIT 10
 """
 
-df5 = conn.execute(query5).fetchdf()
+df5 = run_if_stale('query5_max_volume', query5)
 print(df5.to_string(index=False))
-df5.to_csv('query_outputs/query5_max_volume.csv', index=False)
-print("\nSaved: query_outputs/query5_max_volume.csv")
 
 # QUERY 6: Intraday Price Movement
 print("\n[6/7] QUERY 6: Intraday Price Movement Analysis")
 print("-" * 100)
 
 query6 = """
+WITH per_row AS (
+    SELECT 
+        i.symbol,
+        t.trade_date,
+        t.high_paise - t.low_paise as range_paise,
+        (t.high_paise - t.low_paise) / t.close_paise * 100 as range_pct  -- close_paise > 0 below
+    FROM trades t
+    JOIN instruments i ON t.instrument_id = i.instrument_id
+    WHERE t.high_paise > t.low_paise
+        AND t.close_paise > 0
+)
 SELECT 
-    i.symbol,
-    t.trade_date,
-    ROUND(AVG(t.high - t.low), 2) as avg_range,
-    ROUND(AVG((t.high - t.low) / NULLIF(t.close, 0) * 100), 2) as avg_range_pct,
-    ROUND(MAX(t.high - t.low), 2) as max_range,
+    symbol,
+    trade_date,
+    ROUND(AVG(range_paise)) / 100.0 as avg_range,
+    ROUND(AVG(range_pct), 2) as avg_range_pct,
+    MAX(range_paise) / 100.0 as max_range,
     COUNT(*) as num_contracts
-FROM trades t
-JOIN instruments i ON t.instrument_id = i.instrument_id
-WHERE (t.high - t.low) > 0
-    AND t.close > 0
-GROUP BY i.symbol, t.trade_date
+FROM per_row
+GROUP BY symbol, trade_date
 HAVING avg_range_pct > 5
 ORDER BY avg_range_pct DESC
 LIMIT 10
 """
 
-df6 = conn.execute(query6).fetchdf()
+df6 = run_if_stale('query6_price_movement', query6)
 print(df6.to_string(index=False))
-df6.to_csv('query_outputs/query6_price_movement.csv', index=False)
-print("\nSaved: query_outputs/query6_price_movement.csv")
 
 # ============================================================================
 # QUERY 7: Most Active Options by Expiry
@@ -225,25 +234,20 @@ print("-" * 100)
 
 query7 = """
 SELECT 
-    i.symbol,
-    ex.expiry_date,
-    COUNT(DISTINCT ex.strike_price) as num_strikes,
-    SUM(t.contracts) as total_volume,
-    ROUND(SUM(t.value_in_lakh), 2) as total_value_lakh,
-    ROUND(AVG(t.open_interest), 0) as avg_oi
-FROM trades t
-JOIN expiries ex ON t.expiry_id = ex.expiry_id
-JOIN instruments i ON t.instrument_id = i.instrument_id
-WHERE ex.option_type IN ('CE', 'PE')
-GROUP BY i.symbol, ex.expiry_date
+    symbol,
+    expiry_date,
+    COUNT(DISTINCT strike_price) as num_strikes,
+    SUM(sum_contracts) as total_volume,
+    ROUND(SUM(sum_value_lakh), 2) as total_value_lakh,
+    ROUND(SUM(sum_oi) / SUM(n_rows), 0) as avg_oi
+FROM daily_option_agg
+GROUP BY symbol, expiry_date
 ORDER BY total_volume DESC
 LIMIT 15
 """
 
-df7 = conn.execute(query7).fetchdf()
+df7 = run_if_stale('query7_active_expiries', query7)
 print(df7.to_string(index=False))
-df7.to_csv('query_outputs/query7_active_expiries.csv', index=False)
-print("\nSaved: query_outputs/query7_active_expiries.csv")
 
 # ============================================================================
 # Summary Statistics
@@ -274,6 +278,7 @@ SELECT 'Total Value (Lakh)', FORMAT('{:,.2f}', SUM(value_in_lakh)) FROM trades
 
 print(stats.to_string(index=False))
 
+conn.execute("COMMIT")
 conn.close()
 
 print("\n" + "=" * 100)
@@ -3,7 +3,7 @@ F&O Analytics Visualization Script
 Generate charts and graphs from query results
 """
 
-import pandas as pd
+import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
 import duckdb
@@ -21,26 +21,36 @@ output_dir = Path('results')
 output_dir.mkdir(exist_ok=True)
 
 
+def fetch_arrays(query):
+    """Run a query and return its columns as NumPy arrays via Arrow (no pandas copy)"""
+    result = conn.execute(query)
+    # to_arrow_table() replaces the deprecated fetch_arrow_table() in newer DuckDB
+    if hasattr(result, 'to_arrow_table'):
+        tbl = result.to_arrow_table()
+    else:
+        tbl = result.fetch_arrow_table()
+    return {c: tbl.column(c).to_numpy() for c in tbl.column_names}
+
+
 def plot_oi_trends():
     """Plot Open Interest trends over time"""
     query = """
         SELECT 
-            i.symbol,
-            t.trade_date,
-            SUM(t.open_interest) as total_oi
-        FROM trades t
-        JOIN instruments i ON t.instrument_id = i.instrument_id
-        WHERE i.symbol IN ('NIFTY', 'BANKNIFTY')
-        GROUP BY i.symbol, t.trade_date
-        ORDER BY t.trade_date
+            symbol,
+            trade_date,
+            CAST(SUM(sum_oi) AS BIGINT) as total_oi
+        FROM daily_symbol_agg
+        WHERE symbol IN ('NIFTY', 'BANKNIFTY')
+        GROUP BY symbol, trade_date
+        ORDER BY trade_date
     """
     
-    df = conn.execute(query).fetchdf()
+    arrays = fetch_arrays(query)
     
     plt.figure(figsize=(14, 7))
-    for symbol in df['symbol'].unique():
-        data = df[df['symbol'] == symbol]
-        plt.plot(data['trade_date'], data['total_oi'], marker='o', label=symbol, linewidth=2)
+    for symbol in np.unique(arrays['symbol']):
+        mask = arrays['symbol'] == symbol
+        plt.plot(arrays['trade_date'][mask], arrays['total_oi'][mask], marker='o', label=symbol, linewidth=2)
     
     plt.title('Open Interest Trends - NIFTY vs BANKNIFTY', fontsize=16, fontweight='bold')
     plt.xlabel('Trade Date', fontsize=12)
@@ -54,17 +64,30 @@ def plot_oi_trends():
 
 def plot_volume_distribution():
     """Plot volume distribution histogram"""
+    # Bin counts are computed in DuckDB; only the 50 bins come back, as NumPy arrays
     query = """
-        SELECT contracts as volume
-        FROM trades
-        WHERE contracts > 0
-        LIMIT 100000
+        WITH bounds AS (
+            SELECT 
+                MIN(contracts) as lo,
+                GREATEST(MAX(contracts) - MIN(contracts), 1) / 50.0 as width
+            FROM trades
+            WHERE contracts > 0
+        )
+        SELECT 
+            b.lo + LEAST(FLOOR((t.contracts - b.lo) / b.width), 49) * b.width as bin_start,
+            ANY_VALUE(b.width) as bin_width,
+            COUNT(*) as freq
+        FROM trades t, bounds b
+        WHERE t.contracts > 0
+        GROUP BY bin_start
+        ORDER BY bin_start
     """
     
-    df = conn.execute(query).fetchdf()
+    arrays = fetch_arrays(query)
     
     plt.figure(figsize=(12, 6))
-    plt.hist(df['volume'], bins=50, edgecolor='black', alpha=0.7, color='steelblue')
+    plt.bar(arrays['bin_start'], arrays['freq'], width=arrays['bin_width'], align='edge',
+            edgecolor='black', alpha=0.7, color='steelblue')
     plt.title('Trading Volume Distribution', fontsize=16, fontweight='bold')
     plt.xlabel('Contracts Traded', fontsize=12)
     plt.ylabel('Frequency', fontsize=12)
@@ -76,33 +99,43 @@ def plot_volume_distribution():
 
 def plot_volatility_heatmap():
     """Plot volatility heatmap by strike and date"""
+    # DuckDB pivots to one row per strike and one column per trade date
     query = """
         WITH daily_volatility AS (
             SELECT 
-                ex.strike_price,
+                CAST(ex.strike_price AS DOUBLE) as strike_price,
                 t.trade_date,
-                STDDEV(t.close) as volatility
+                STDDEV(t.close_paise) / 100.0 as volatility
             FROM trades t
             JOIN expiries ex ON t.expiry_id = ex.expiry_id
             JOIN instruments i ON t.instrument_id = i.instrument_id
             WHERE i.symbol = 'NIFTY'
                 AND ex.option_type = 'CE'
                 AND ex.strike_price BETWEEN 10800 AND 11200
+                AND t.year_month = '2019-08'  -- hive partition pruning
                 AND t.trade_date >= '2019-08-01'
                 AND t.trade_date <= '2019-08-15'
             GROUP BY ex.strike_price, t.trade_date
         )
-        SELECT * FROM daily_volatility
-        WHERE volatility IS NOT NULL
+        SELECT * FROM (
+            PIVOT (SELECT * FROM daily_volatility WHERE volatility IS NOT NULL)
+            ON trade_date
+            USING MAX(volatility)
+            GROUP BY strike_price
+        )
+        ORDER BY strike_price
     """
     
-    df = conn.execute(query).fetchdf()
+    arrays = fetch_arrays(query)
     
-    if len(df) > 0:
-        pivot = df.pivot(index='strike_price', columns='trade_date', values='volatility')
+    if len(arrays['strike_price']) > 0:
+        strikes = arrays.pop('strike_price')
+        dates = sorted(arrays)
+        # Missing (strike, date) cells arrive as NaN
+        grid = np.column_stack([arrays[d] for d in dates])
         
         plt.figure(figsize=(14, 8))
-        sns.heatmap(pivot, cmap='YlOrRd', annot=False, fmt='.1f', cbar_kws={'label': 'Volatility'})
+        sns.heatmap(grid, xticklabels=dates, yticklabels=strikes, cmap='YlOrRd', annot=False, fmt='.1f', cbar_kws={'label': 'Volatility'})
         plt.title('NIFTY Call Options Volatility Heatmap', fontsize=16, fontweight='bold')
         plt.xlabel('Trade Date', fontsize=12)
         plt.ylabel('Strike Price', fontsize=12)
@@ -118,39 +151,32 @@ def plot_option_chain():
     """Plot option chain (Call vs Put volumes)"""
     query = """
         SELECT 
-            ex.strike_price,
-            ex.option_type,
-            SUM(t.contracts) as total_volume
-        FROM trades t
-        JOIN expiries ex ON t.expiry_id = ex.expiry_id
-        JOIN instruments i ON t.instrument_id = i.instrument_id
-        WHERE i.symbol = 'NIFTY'
-            AND ex.expiry_date = '2019-08-29'
-            AND t.trade_date = '2019-08-01'
-            AND ex.option_type IN ('CE', 'PE')
-        GROUP BY ex.strike_price, ex.option_type
-        ORDER BY ex.strike_price
+            CAST(strike_price AS DOUBLE) as strike_price,
+            CAST(COALESCE(SUM(sum_contracts) FILTER (WHERE option_type = 'CE'), 0) AS BIGINT) as ce_volume,
+            CAST(COALESCE(SUM(sum_contracts) FILTER (WHERE option_type = 'PE'), 0) AS BIGINT) as pe_volume
+        FROM daily_option_agg
+        WHERE symbol = 'NIFTY'
+            AND expiry_date = '2019-08-29'
+            AND trade_date = '2019-08-01'
+        GROUP BY strike_price
+        ORDER BY strike_price
     """
     
-    df = conn.execute(query).fetchdf()
+    arrays = fetch_arrays(query)
     
-    if len(df) > 0:
-        pivot = df.pivot(index='strike_price', columns='option_type', values='total_volume').fillna(0)
-        
+    if len(arrays['strike_price']) > 0:
         fig, ax = plt.subplots(figsize=(14, 7))
-        x = range(len(pivot))
+        x = np.arange(len(arrays['strike_price']))
         width = 0.35
         
-        if 'CE' in pivot.columns:
-            ax.bar([i - width/2 for i in x], pivot['CE'], width, label='Call (CE)', color='green', alpha=0.7)
-        if 'PE' in pivot.columns:
-            ax.bar([i + width/2 for i in x], pivot['PE'], width, label='Put (PE)', color='red', alpha=0.7)
+        ax.bar(x - width/2, arrays['ce_volume'], width, label='Call (CE)', color='green', alpha=0.7)
+        ax.bar(x + width/2, arrays['pe_volume'], width, label='Put (PE)', color='red', alpha=0.7)
         
         ax.set_xlabel('Strike Price', fontsize=12)
         ax.set_ylabel('Total Volume', fontsize=12)
         ax.set_title('NIFTY Option Chain - Call vs Put Volumes (Aug 29, 2019)', fontsize=16, fontweight='bold')
         ax.set_xticks(x)
-        ax.set_xticklabels(pivot.index, rotation=45)
+        ax.set_xticklabels(arrays['strike_price'], rotation=45)
         ax.legend(fontsize=12)
         plt.tight_layout()
         plt.savefig(output_dir / 'option_chain_visualization.png', dpi=300)